@@ -29,8 +29,35 @@ showing the expected renderings.
 
 In order to avoid one-off dependencies for this task, this script uses
 a reasonably working HTML parser and the existing XPath implementation
-from Python 2's standard library. Hopefully we won't render
-non-well-formed HTML.
+from Python's standard library. Hopefully we won't render
+non-well-formed HTML. If `lxml` happens to be installed, its (much
+faster) libxml2-based HTML parser is used instead. Its tree is fixed up
+to match the fallback one for rustdoc outputs (void elements unknown to
+libxml2 and HTML 5 entities), but the two can still differ in edge
+cases, e.g. a valueless attribute is `""` in one and its name in the
+other. Similarly, `pyahocorasick` is used to search for all `@has`
+patterns of a file in a single pass if available.
+
+`@matches` patterns can be run with the linear-time `re2` engine instead
+by setting the `HTMLDOCCK_RE2` environment variable (`re2` has to be
+installed). This is opt-in because re2 does not match exactly like
+Python's `re`; for example `$` matches only at the very end and not
+before a trailing newline, and `\w`, `\d` and `\s` are ASCII-only.
+Patterns which re2 rejects (e.g. backreferences or `\Z`) still use `re`.
+
+Parsing HTML files is the most expensive part of checking, so parsed
+trees can be cached across runs: if the `HTMLDOCCK_CACHE_DIR` environment
+variable is set, every tree is stored there as XML (which is much faster
+to parse) keyed by a hash of the HTML file and the parser in use
+(including lxml and libxml2 versions), and reused when a file with
+the same contents is checked again with the same parser. Trees with
+prefixed names (e.g. `xlink:href`) are not valid XML without namespace
+declarations, so they are always parsed from HTML.
+
+Commands on different files can be checked in parallel by setting the
+`HTMLDOCCK_JOBS` environment variable to the number of worker processes.
+This is off by default because compiletest already runs one htmldocck
+per core; it pays off only for templates touching many files.
 
 # Commands
 
@@ -106,17 +133,53 @@ checks if the given file does not exist, for example.
 
 from __future__ import print_function
 import sys
+import io
 import os.path
+import mmap
+import hashlib
+import tempfile
 import re
 import shlex
-from collections import namedtuple
-from HTMLParser import HTMLParser
-from xml.etree import cElementTree as ET
+import multiprocessing
+from collections import namedtuple, OrderedDict
+
+PY3 = sys.version_info[0] >= 3
+if PY3:
+    from html.parser import HTMLParser
+    from html.entities import name2codepoint
+    unichr = chr
+else:
+    from HTMLParser import HTMLParser
+    from htmlentitydefs import name2codepoint
+
+try:
+    from xml.etree import cElementTree as ET
+except ImportError: # removed in Python 3.9, where ElementTree is always fast
+    from xml.etree import ElementTree as ET
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+re2 = None
+if os.environ.get('HTMLDOCCK_RE2'): # see the module docs
+    try:
+        import re2
+    except ImportError:
+        pass
+
+# entities used by rustdoc which are not in HTML 4 but are in HTML 5;
+# libxml2 before 2.14 does not know about them either
+HTML5_ENTITIES = {'larrb': 0x21e4, 'rarrb': 0x21e5}
 
-# &larrb;/&rarrb; are not in HTML 4 but are in HTML 5
-from htmlentitydefs import entitydefs
-entitydefs['larrb'] = u'\u21e4'
-entitydefs['rarrb'] = u'\u21e5'
+ENTITIES = dict((name, unichr(code)) for name, code in name2codepoint.items())
+ENTITIES.update((name, unichr(code)) for name, code in HTML5_ENTITIES.items())
 
 # "void elements" (no closing tag) from the HTML Standard section 12.1.2
 VOID_ELEMENTS = set(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen',
@@ -130,7 +193,11 @@ class CustomHTMLParser(HTMLParser):
     rustdoc; we only have to deal with i) void elements and ii) empty
     attributes."""
     def __init__(self, target=None):
-        HTMLParser.__init__(self)
+        if PY3:
+            # entity and character references are handled by ourselves
+            HTMLParser.__init__(self, convert_charrefs=False)
+        else:
+            HTMLParser.__init__(self)
         self.__builder = target or ET.TreeBuilder()
 
     def handle_starttag(self, tag, attrs):
@@ -151,17 +218,109 @@ class CustomHTMLParser(HTMLParser):
         self.__builder.data(data)
 
     def handle_entityref(self, name):
-        self.__builder.data(entitydefs[name])
+        self.__builder.data(ENTITIES[name])
 
     def handle_charref(self, name):
         code = int(name[1:], 16) if name.startswith(('x', 'X')) else int(name, 10)
-        self.__builder.data(unichr(code).encode('utf-8'))
+        self.__builder.data(unichr(code))
 
     def close(self):
         HTMLParser.close(self)
         return self.__builder.close()
 
-Command = namedtuple('Command', 'negated cmd args lineno context')
+def _unnest_void_elements(tree):
+    """libxml2 does not know about some HTML 5 void elements (e.g. `<wbr>`)
+    and puts everything following them into their children instead.
+    this moves such misplaced contents back next to the element."""
+    for e in reversed(list(tree.iter(*VOID_ELEMENTS))):
+        if e.text is None and len(e) == 0:
+            continue
+        parent = e.getparent()
+        index = parent.index(e)
+        children = list(e)
+        tail = e.tail
+        e.tail = e.text
+        e.text = None
+        for i, child in enumerate(children):
+            parent.insert(index + 1 + i, child)
+        last = children[-1] if children else e
+        last.tail = (last.tail or '') + (tail or '') or None
+
+def parse_html(abspath):
+    if lxml_etree is not None:
+        with open(abspath, 'rb') as f:
+            data = f.read()
+        for name, code in HTML5_ENTITIES.items():
+            data = data.replace('&{};'.format(name).encode('ascii'),
+                                '&#{};'.format(code).encode('ascii'))
+        tree = lxml_etree.parse(io.BytesIO(data), lxml_etree.HTMLParser(encoding='utf-8'))
+        _unnest_void_elements(tree)
+    else:
+        # the parser is fed with unicode, so that the decoded entity and
+        # character references can be joined with the surrounding text
+        with io.open(abspath, encoding='utf-8') as f:
+            tree = ET.parse(f, CustomHTMLParser())
+    return tree
+
+# a directory for caching parsed trees across runs, see the module docs
+TREE_CACHE_DIR = os.environ.get('HTMLDOCCK_CACHE_DIR')
+
+# should be bumped whenever `parse_html` produces different trees
+TREE_CACHE_VERSION = 1
+
+def tree_cache_path(abspath):
+    # trees from different parsers (or their versions) are not exactly same
+    if lxml_etree is not None:
+        parser = 'lxml-{}-libxml2-{}'.format('.'.join(map(str, lxml_etree.LXML_VERSION)),
+                                             '.'.join(map(str, lxml_etree.LIBXML_VERSION)))
+    else:
+        parser = 'et'
+    key = hashlib.sha1('{}:{}:'.format(TREE_CACHE_VERSION, parser).encode('ascii'))
+    with open(abspath, 'rb') as f:
+        key.update(f.read())
+    return os.path.join(TREE_CACHE_DIR, '{}.xml'.format(key.hexdigest()))
+
+def has_prefixed_names(tree):
+    """checks if `tree` has tags or attributes with a prefix (e.g. `xlink:href`).
+    they are written as undeclared namespace prefixes, which XML parsers reject."""
+    return any(':' in e.tag or any(':' in name for name in e.keys())
+               for e in tree.iter('*'))
+
+def load_cached_tree(cache_path):
+    """returns None for trees which could not be cached (empty entries)."""
+    if os.path.getsize(cache_path) == 0:
+        return None
+    try:
+        if lxml_etree is not None:
+            return lxml_etree.parse(cache_path)
+        else:
+            return ET.parse(cache_path)
+    except Exception:
+        return None # a broken cache entry is treated like an empty one
+
+def store_cached_tree(cache_path, tree):
+    temp_path = None
+    try:
+        if not os.path.isdir(TREE_CACHE_DIR):
+            os.makedirs(TREE_CACHE_DIR)
+        # the file is renamed into place, so concurrent runs never see
+        # a partially written tree
+        with tempfile.NamedTemporaryFile(dir=TREE_CACHE_DIR, delete=False) as f:
+            temp_path = f.name
+            # trees which cannot be read back are stored as empty entries,
+            # so that they are not parsed and written again on every run
+            if not has_prefixed_names(tree):
+                tree.write(f, encoding='utf-8')
+        os.rename(temp_path, cache_path)
+    except Exception:
+        # the cache is purely an optimization
+        if temp_path is not None and os.path.exists(temp_path):
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+
+Command = namedtuple('Command', 'negated cmd args lineno context check')
 
 class FailedCheck(Exception):
     pass
@@ -169,40 +328,50 @@ class FailedCheck(Exception):
 class InvalidCheck(Exception):
     pass
 
-def concat_multi_lines(f):
+def common_prefix_len(a, b):
+    """returns the length of the longest common prefix of `a` and `b`.
+    this does a binary search over slices, so that the comparison of
+    individual characters happens in C."""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def concat_multi_lines(f, errors):
     """returns a generator out of the file object, which
     - removes `\\` then `\n` then a shared prefix with the previous line then
       optional whitespace;
     - keeps a line number (starting from 0) of the first line being
-      concatenated."""
+      concatenated.
+    syntax errors are appended to `errors` as `(lineno, line, message)`."""
     lastline = None # set to the last line when the last line has a backslash
     firstlineno = None
-    catenated = ''
+    parts = [] # continued lines, without their trailing backslashes
     for lineno, line in enumerate(f):
         line = line.rstrip('\r\n')
 
         # strip the common prefix from the current line if needed
         if lastline is not None:
-            maxprefix = 0
-            for i in xrange(min(len(line), len(lastline))):
-                if line[i] != lastline[i]:
-                    break
-                maxprefix += 1
-            line = line[maxprefix:].lstrip()
+            line = line[common_prefix_len(line, lastline):].lstrip()
 
         firstlineno = firstlineno or lineno
         if line.endswith('\\'):
             if lastline is None:
                 lastline = line[:-1]
-            catenated += line[:-1]
+            parts.append(line[:-1])
         else:
-            yield firstlineno, catenated + line
+            parts.append(line)
+            yield firstlineno, ''.join(parts)
             lastline = None
             firstlineno = None
-            catenated = ''
+            parts = []
 
     if lastline is not None:
-        print_err(lineno, line, 'Trailing backslash at the end of the file')
+        errors.append((lineno, line, 'Trailing backslash at the end of the file'))
 
 LINE_PATTERN = re.compile(r'''
     (?<=(?<!\S)@)(?P<negated>!?)
@@ -210,10 +379,38 @@ LINE_PATTERN = re.compile(r'''
     (?P<args>.*)$
 ''', re.X)
 
+# arguments without backslashes and adjacent quoted parts, which are split
+# without going through `shlex`
+SIMPLE_ARGS_PATTERN = re.compile(r'''
+    (?:\s*(?:"[^"\\]*"|'[^']*'|[^\s"'\\]+)(?=\s|$))*\s*$
+''', re.X)
+SIMPLE_ARG_PATTERN = re.compile(r'''
+    "([^"\\]*)"|'([^']*)'|([^\s"'\\]+)
+''', re.X)
+
+
+def split_args(args):
+    if SIMPLE_ARGS_PATTERN.match(args):
+        return [a or b or c for a, b, c in SIMPLE_ARG_PATTERN.findall(args)]
+    return shlex.split(args)
+
+
+def template_error(lineno, line, message):
+    """returns a command reporting `message`, so that errors in the template
+    are reported in order with the checks."""
+    return Command(negated=False, cmd=None, args=[], lineno=lineno, context=line,
+                   check=BadCommand(message))
+
 
 def get_commands(template):
-    with open(template, 'rUb') as f:
-        for lineno, line in concat_multi_lines(f):
+    last_path = None
+    errors = []
+    if PY3:
+        f = open(template, 'r', encoding='utf-8')
+    else:
+        f = open(template, 'rU')
+    with f:
+        for lineno, line in concat_multi_lines(f, errors):
             m = LINE_PATTERN.search(line)
             if not m:
                 continue
@@ -222,25 +419,43 @@ def get_commands(template):
             cmd = m.group('cmd')
             args = m.group('args')
             if args and not args[:1].isspace():
-                print_err(lineno, line, 'Invalid template syntax')
+                yield template_error(lineno, line, 'Invalid template syntax')
                 continue
-            args = shlex.split(args)
-            yield Command(negated=negated, cmd=cmd, args=args, lineno=lineno+1, context=line)
+            args = split_args(args)
+
+            # replace `-` with the most recently used path, so that each
+            # command can be checked on its own. `-` is kept when there is
+            # no previous path, and reported when the command is checked.
+            if args and cmd in ('has', 'matches', 'count'):
+                if args[0] != '-':
+                    last_path = args[0]
+                elif last_path is not None:
+                    args[0] = last_path
+
+            yield Command(negated=negated, cmd=cmd, args=args, lineno=lineno+1, context=line,
+                          check=build_check(negated, cmd, args))
+
+    for error in errors:
+        yield template_error(*error)
+
+
+def find_literals(data, patterns):
+    """returns a set of `patterns` occurring in `data`.
 
+    all patterns are searched in a single pass when pyahocorasick is
+    available; otherwise each pattern is searched separately."""
+    if ahocorasick is None or len(patterns) < 2:
+        return set(pat for pat in patterns if data.find(pat) != -1)
 
-def _flatten(node, acc):
-    if node.text:
-        acc.append(node.text)
-    for e in node:
-        _flatten(e, acc)
-        if e.tail:
-            acc.append(e.tail)
+    automaton = ahocorasick.Automaton()
+    for pat in patterns:
+        automaton.add_word(pat, pat)
+    automaton.make_automaton()
+    return set(pat for _, pat in automaton.iter(data))
 
 
-def flatten(node):
-    acc = []
-    _flatten(node, acc)
-    return ''.join(acc)
+def normalize_whitespace(s):
+    return ' '.join(s.split())
 
 
 def normalize_xpath(path):
@@ -252,99 +467,345 @@ def normalize_xpath(path):
         raise InvalidCheck('Non-absolute XPath is not supported due to implementation issues')
 
 
+# compiled XPath expressions, shared by every check using the same path
+COMPILED_XPATHS = {}
+
+def compile_xpath(path, attr=None):
+    """returns a function which returns an iterable of elements in given tree
+    matching `path`, or the values of their `attr` attributes if given."""
+    compiled = COMPILED_XPATHS.get((path, attr))
+    if compiled is None:
+        xpath = normalize_xpath(path)
+        # lxml trees are searched with lxml's own ElementPath as well:
+        # a compiled `etree.XPath` always builds the whole (sorted and
+        # merged) node-set, which is several times slower on large pages
+        # and cannot stop at the first match.
+        # ElementPath has no separate compilation step; running the
+        # path once reports syntax errors now instead of at the check
+        try:
+            (lxml_etree or ET).Element('html').findall(xpath)
+        except KeyError:
+            # unknown tokens (`//a]`, `//a/text()`) are looked up as is
+            raise SyntaxError('invalid path')
+        except TypeError:
+            # Python 3 leaves a None selector for an unterminated
+            # predicate (`//a[`) and only fails when calling it
+            raise SyntaxError('invalid path')
+        # ElementPath keeps its own cache of parsed paths. this is lazy,
+        # so checks stopping at the first match skip the remaining work
+        if attr is None:
+            compiled = lambda tree: tree.iterfind(xpath)
+        else:
+            compiled = lambda tree: (e.get(attr) for e in tree.iterfind(xpath)
+                                     if attr in e.attrib)
+        COMPILED_XPATHS[path, attr] = compiled
+    return compiled
+
+
+# files at least this large are mapped rather than read, so that their
+# (possibly huge) contents are not kept around in memory twice with the
+# normalized one. every mapping keeps a file descriptor open until closed
+MMAP_MIN_SIZE = 1 << 20
+
+def read_file(abspath):
+    """returns the contents of given file, as a read-only mapping if large."""
+    with open(abspath, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < MMAP_MIN_SIZE:
+            return f.read()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 class CachedFiles(object):
     def __init__(self, root):
         self.root = root
         self.files = {}
+        self.normalized = {}
         self.trees = {}
-        self.last_path = None
+        self.literals = {} # path -> literal @has patterns expected to be checked
+        self.found_literals = {} # path -> subset of `self.literals[path]` found
+        self.resolved = {} # path -> normalized path
 
     def resolve_path(self, path):
-        if path != '-':
-            path = os.path.normpath(path)
-            self.last_path = path
-            return path
-        elif self.last_path is None:
-            raise InvalidCheck('Tried to use the previous path in the first command')
-        else:
-            return self.last_path
+        """`-` should have been already replaced by `get_commands`."""
+        resolved = self.resolved.get(path)
+        if resolved is None:
+            if path == '-':
+                raise InvalidCheck('Tried to use the previous path in the first command')
+            resolved = self.resolved[path] = os.path.normpath(path)
+        return resolved
+
+    def check_file(self, path):
+        """returns the absolute path to given file, which should exist."""
+        path = self.resolve_path(path)
+        abspath = os.path.join(self.root, path)
+        if not(os.path.exists(abspath) and os.path.isfile(abspath)):
+            raise FailedCheck('File does not exist {!r}'.format(path))
+        return abspath
 
     def get_file(self, path):
+        """returns the raw contents of given file for `@matches`."""
         path = self.resolve_path(path)
         if path in self.files:
             return self.files[path]
 
-        abspath = os.path.join(self.root, path)
-        if not(os.path.exists(abspath) and os.path.isfile(abspath)):
-            raise FailedCheck('File does not exist {!r}'.format(path))
+        data = self.files[path] = read_file(self.check_file(path))
+        return data
 
-        with open(abspath) as f:
-            data = f.read()
-            self.files[path] = data
-            return data
+    def get_normalized_file(self, path):
+        path = self.resolve_path(path)
+        if path in self.normalized:
+            return self.normalized[path]
+
+        data = self.files.get(path)
+        if data is None:
+            # not kept, only the normalized contents are needed later
+            data = read_file(self.check_file(path))
+        if PY3:
+            text = str(data, 'utf-8') # decodes straight from the mapping
+        else:
+            text = data[:]
+        if path not in self.files and isinstance(data, mmap.mmap):
+            data.close()
+        text = self.normalized[path] = normalize_whitespace(text)
+        return text
+
+    def add_literals(self, commands):
+        """collects literal `@has PATH PATTERN` patterns from `commands` so that
+        they can be searched at once per file."""
+        for c in commands:
+            if isinstance(c.check, StringHas) and c.check.pat and c.check.path != '-':
+                path = self.resolve_path(c.check.path)
+                self.literals.setdefault(path, set()).add(c.check.pat)
+
+    def has_literal(self, path, pat):
+        """checks if the whitespace-normalized `pat` occurs in the given file."""
+        path = self.resolve_path(path)
+        data = self.get_normalized_file(path)
+        literals = self.literals.get(path, ())
+        if pat not in literals: # not known in advance
+            return data.find(pat) != -1
+
+        found = self.found_literals.get(path)
+        if found is None:
+            found = self.found_literals[path] = find_literals(data, literals)
+        return pat in found
 
     def get_tree(self, path):
         path = self.resolve_path(path)
         if path in self.trees:
             return self.trees[path]
 
-        abspath = os.path.join(self.root, path)
-        if not(os.path.exists(abspath) and os.path.isfile(abspath)):
-            raise FailedCheck('File does not exist {!r}'.format(path))
+        abspath = self.check_file(path)
 
-        with open(abspath) as f:
+        cache_path = tree_cache_path(abspath) if TREE_CACHE_DIR else None
+        cached = cache_path is not None and os.path.isfile(cache_path)
+        tree = load_cached_tree(cache_path) if cached else None
+        if tree is None:
             try:
-                tree = ET.parse(f, CustomHTMLParser())
+                tree = parse_html(abspath)
             except Exception as e:
                 raise RuntimeError('Cannot parse an HTML file {!r}: {}'.format(path, e))
-            self.trees[path] = tree
-            return self.trees[path]
+            if cache_path and not cached:
+                store_cached_tree(cache_path, tree)
+        self.trees[path] = tree
+        return tree
+
 
+# compiled `@matches` patterns, shared by every check using the same pattern
+COMPILED_PATTERNS = {}
 
-def check_string(data, pat, regexp):
+def compile_re2_pattern(pat):
+    """returns a linear-time matcher for `pat` from re2, or None when re2 is
+    not available or does not support `pat` (e.g. backreferences)."""
+    if re2 is None:
+        return None
+    try:
+        if hasattr(re2, 'Options'): # google-re2; errors are raised anyway
+            options = re2.Options()
+            options.log_errors = False
+            return re2.compile(pat, options)
+        return re2.compile(pat)
+    except Exception:
+        return None
+
+def compile_pattern(pat):
+    compiled = COMPILED_PATTERNS.get(pat)
+    if compiled is None:
+        compiled = compile_re2_pattern(pat) or re.compile(pat)
+        COMPILED_PATTERNS[pat] = compiled
+    return compiled
+
+
+def compile_matcher(pat, regexp):
+    """returns a function checking if `pat` occurs in given string."""
     if not pat:
-        return True # special case a presence testing
+        return lambda data: True # special case a presence testing
     elif regexp:
-        return re.search(pat, data) is not None
+        return compile_pattern(pat).search
     else:
-        data = ' '.join(data.split())
-        pat = ' '.join(pat.split())
-        return pat in data
+        pat = normalize_whitespace(pat)
+        return lambda data: normalize_whitespace(data).find(pat) != -1
 
 
-def check_tree_attr(tree, path, attr, pat, regexp):
-    path = normalize_xpath(path)
-    ret = False
-    for e in tree.findall(path):
-        if attr in e.attrib:
-            value = e.attrib[attr]
-        else:
-            continue
+class Check(object):
+    """a single check, with all of its arguments processed in advance."""
+    error = '' # reported when the check fails
 
-        ret = check_string(value, pat, regexp)
-        if ret:
-            break
-    return ret
+    def __init__(self, negated, path):
+        self.negated = negated
+        self.path = path
 
+    def run(self, cache):
+        """raises FailedCheck when the check fails. subclasses implement
+        `test(cache)` returning if the condition holds."""
+        if self.test(cache) == self.negated:
+            raise FailedCheck(self.error)
 
-def check_tree_text(tree, path, pat, regexp):
-    path = normalize_xpath(path)
-    ret = False
-    for e in tree.findall(path):
+
+class FileExists(Check):
+    def test(self, cache):
         try:
-            value = flatten(e)
-        except KeyError:
-            continue
+            cache.check_file(self.path)
+        except FailedCheck:
+            if not self.negated:
+                raise # reports the missing file
+            return False
+        return True
+
+
+class StringHas(Check):
+    error = "`PATTERN` did not match"
+
+    def __init__(self, negated, path, pat):
+        Check.__init__(self, negated, path)
+        # the file is whitespace-normalized as well
+        self.pat = normalize_whitespace(pat)
+
+    def test(self, cache):
+        if not self.pat:
+            cache.check_file(self.path)
+            return True # special case a presence testing
+        return cache.has_literal(self.path, self.pat)
+
+
+class StringMatches(Check):
+    error = "`PATTERN` did not match"
+
+    def __init__(self, negated, path, pat):
+        Check.__init__(self, negated, path)
+        if PY3:
+            pat = pat.encode('utf-8') # matched against the mapped file
+        self.match = compile_matcher(pat, True)
+
+    def test(self, cache):
+        return bool(self.match(cache.get_file(self.path)))
+
+
+def iter_elements(results):
+    """passes through XPath `results`, which should be elements."""
+    for e in results:
+        if not ET.iselement(e):
+            raise InvalidCheck('XPath should select elements, not {!r}'.format(e))
+        yield e
+
+
+class TreeAttr(Check):
+    error = "`XPATH PATTERN` did not match"
+
+    def __init__(self, negated, path, xpath, attr, pat, regexp):
+        Check.__init__(self, negated, path)
+        self.xpath = compile_xpath(xpath, attr)
+        self.match = compile_matcher(pat, regexp)
+
+    def test(self, cache):
+        return any(self.match(value) for value in self.xpath(cache.get_tree(self.path)))
+
+
+class TreeText(Check):
+    error = "`XPATH PATTERN` did not match"
+
+    def __init__(self, negated, path, xpath, pat, regexp):
+        Check.__init__(self, negated, path)
+        self.xpath = compile_xpath(xpath)
+        self.match = compile_matcher(pat, regexp)
+
+    def test(self, cache):
+        return any(self.match(''.join(e.itertext()))
+                   for e in iter_elements(self.xpath(cache.get_tree(self.path))))
+
+
+class TreeCount(Check):
+    def __init__(self, negated, path, xpath, count):
+        Check.__init__(self, negated, path)
+        self.xpath = compile_xpath(xpath)
+        self.count = count
+
+    def test(self, cache):
+        return sum(1 for _ in iter_elements(self.xpath(cache.get_tree(self.path)))) == self.count
+
+
+class BadCommand(Check):
+    """a command which could not be processed, reported when checked."""
+    def __init__(self, message):
+        Check.__init__(self, False, None)
+        self.message = message
+
+    def run(self, cache):
+        raise InvalidCheck(self.message)
+
+
+def make_check(negated, cmd, args):
+    if cmd == 'has' or cmd == 'matches': # string test
+        regexp = (cmd == 'matches')
+        if len(args) == 1 and not regexp: # @has <path> = file existence
+            return FileExists(negated, args[0])
+        elif len(args) == 2: # @has/matches <path> <pat> = string test
+            if regexp:
+                return StringMatches(negated, args[0], args[1])
+            else:
+                return StringHas(negated, args[0], args[1])
+        elif len(args) == 3: # @has/matches <path> <pat> <match> = XML tree test
+            pat = args[2]
+            if not PY3:
+                pat = pat.decode('utf-8') # texts and attributes in HTML trees are unicode
+            xpath, sep, attr = args[1].partition('/@')
+            if sep: # attribute
+                return TreeAttr(negated, args[0], xpath, attr, pat, regexp)
+            else: # normalized text
+                xpath = args[1]
+                if xpath.endswith('/text()'):
+                    xpath = xpath[:-7]
+                return TreeText(negated, args[0], xpath, pat, regexp)
+        else:
+            raise InvalidCheck('Invalid number of @{} arguments'.format(cmd))
+
+    elif cmd == 'count': # count test
+        if len(args) == 3: # @count <path> <pat> <count> = count test
+            try:
+                count = int(args[2])
+            except ValueError:
+                raise InvalidCheck('Invalid @count COUNT {!r}'.format(args[2]))
+            return TreeCount(negated, args[0], args[1], count)
         else:
-            ret = check_string(value, pat, regexp)
-            if ret:
-                break
-    return ret
+            raise InvalidCheck('Invalid number of @{} arguments'.format(cmd))
+    elif cmd == 'valid-html':
+        raise InvalidCheck('Unimplemented @valid-html')
 
+    elif cmd == 'valid-links':
+        raise InvalidCheck('Unimplemented @valid-links')
+    else:
+        raise InvalidCheck('Unrecognized @{}'.format(cmd))
 
-def check_tree_count(tree, path, count):
-    path = normalize_xpath(path)
-    return len(tree.findall(path)) == count
+def build_check(negated, cmd, args):
+    """same as `make_check` but returns BadCommand for invalid commands."""
+    try:
+        return make_check(negated, cmd, args)
+    except InvalidCheck as err:
+        return BadCommand(str(err))
+    except re.error as err:
+        return BadCommand('Invalid regular expression: {}'.format(err))
+    except SyntaxError as err: # from `compile_xpath`
+        return BadCommand('Invalid XPath: {}'.format(err))
 
 def stderr(*args):
     print(*args, file=sys.stderr)
@@ -361,69 +822,106 @@ def print_err(lineno, context, err, message=None):
 
 ERR_COUNT = 0
 
+# fewer files than this are checked in this process, as starting workers costs more
+PARALLEL_MIN_FILES = 4
+# waiting on a result with a timeout keeps it interruptible (Ctrl-C) in Python 2
+PARALLEL_TIMEOUT = 24 * 60 * 60
+
 def check_command(c, cache):
+    """returns arguments to `print_err` if the check fails."""
     try:
-        cerr = ""
-        if c.cmd == 'has' or c.cmd == 'matches': # string test
-            regexp = (c.cmd == 'matches')
-            if len(c.args) == 1 and not regexp: # @has <path> = file existence
-                try:
-                    cache.get_file(c.args[0])
-                    ret = True
-                except FailedCheck as err:
-                    cerr = err.message
-                    ret = False
-            elif len(c.args) == 2: # @has/matches <path> <pat> = string test
-                cerr = "`PATTERN` did not match"
-                ret = check_string(cache.get_file(c.args[0]), c.args[1], regexp)
-            elif len(c.args) == 3: # @has/matches <path> <pat> <match> = XML tree test
-                cerr = "`XPATH PATTERN` did not match"
-                tree = cache.get_tree(c.args[0])
-                pat, sep, attr = c.args[1].partition('/@')
-                if sep: # attribute
-                    tree = cache.get_tree(c.args[0])
-                    ret = check_tree_attr(tree, pat, attr, c.args[2], regexp)
-                else: # normalized text
-                    pat = c.args[1]
-                    if pat.endswith('/text()'):
-                        pat = pat[:-7]
-                    ret = check_tree_text(cache.get_tree(c.args[0]), pat, c.args[2], regexp)
-            else:
-                raise InvalidCheck('Invalid number of @{} arguments'.format(c.cmd))
-
-        elif c.cmd == 'count': # count test
-            if len(c.args) == 3: # @count <path> <pat> <count> = count test
-                ret = check_tree_count(cache.get_tree(c.args[0]), c.args[1], int(c.args[2]))
-            else:
-                raise InvalidCheck('Invalid number of @{} arguments'.format(c.cmd))
-        elif c.cmd == 'valid-html':
-            raise InvalidCheck('Unimplemented @valid-html')
-
-        elif c.cmd == 'valid-links':
-            raise InvalidCheck('Unimplemented @valid-links')
-        else:
-            raise InvalidCheck('Unrecognized @{}'.format(c.cmd))
-
-        if ret == c.negated:
-            raise FailedCheck(cerr)
-
+        c.check.run(cache)
     except FailedCheck as err:
         message = '@{}{} check failed'.format('!' if c.negated else '', c.cmd)
-        print_err(c.lineno, c.context, err.message, message)
+        return c.lineno, c.context, str(err), message
     except InvalidCheck as err:
-        print_err(c.lineno, c.context, err.message)
+        return c.lineno, c.context, str(err), None
 
-def check(target, commands):
+def check_commands(target, commands):
+    """returns a list of `(index into commands, failure)`, see `check_command`."""
     cache = CachedFiles(target)
-    for c in commands:
-        check_command(c, cache)
+    cache.add_literals(commands)
+    failures = []
+    for i, c in enumerate(commands):
+        failure = check_command(c, cache)
+        if failure:
+            failures.append((i, failure))
+    return failures
+
+def for_worker(c):
+    """returns a command which can be sent to `check_commands_in_worker`.
+    most checks hold compiled patterns and functions which are not picklable,
+    so they are made again by the worker. BadCommand keeps its message, which
+    cannot be made again for template errors."""
+    if isinstance(c.check, BadCommand):
+        return c
+    return c._replace(check=None)
+
+def check_commands_in_worker(args):
+    target, commands = args
+    commands = [c if c.check else c._replace(check=build_check(c.negated, c.cmd, c.args))
+                for c in commands]
+    return check_commands(target, commands)
+
+def parse_jobs(value):
+    """returns the number of worker processes from `HTMLDOCCK_JOBS`, see the module docs."""
+    if not value:
+        return 1
+    try:
+        jobs = int(value)
+    except ValueError:
+        jobs = 0
+    if jobs < 1:
+        stderr('Invalid HTMLDOCCK_JOBS {!r}: should be a positive number of processes'.format(value))
+        raise SystemExit(1)
+    return jobs
+
+def check(target, commands, jobs=1):
+    commands = list(commands)
+
+    # commands on different files are independent of each other,
+    # so they can be checked in parallel. groups hold indices into `commands`
+    groups = OrderedDict()
+    if jobs > 1:
+        cache = CachedFiles(target)
+        for i, c in enumerate(commands):
+            path = c.check.path
+            if path is not None:
+                try:
+                    path = cache.resolve_path(path)
+                except InvalidCheck:
+                    pass # reported when checking
+            groups.setdefault(path, []).append(i)
+
+    if len(groups) < PARALLEL_MIN_FILES:
+        failures = check_commands(target, commands)
+    else:
+        pool = multiprocessing.Pool(min(jobs, len(groups)))
+        try:
+            results = pool.map_async(check_commands_in_worker,
+                                     [(target, [for_worker(commands[i]) for i in group])
+                                      for group in groups.values()]).get(PARALLEL_TIMEOUT)
+        except BaseException:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        failures = sorted((group[i], failure)
+                          for group, result in zip(groups.values(), results)
+                          for i, failure in result)
+
+    for _, failure in failures:
+        print_err(*failure)
 
 if __name__ == '__main__':
     if len(sys.argv) != 3:
         stderr('Usage: {} <doc dir> <template>'.format(sys.argv[0]))
         raise SystemExit(1)
 
-    check(sys.argv[1], get_commands(sys.argv[2]))
+    jobs = parse_jobs(os.environ.get('HTMLDOCCK_JOBS'))
+    check(sys.argv[1], get_commands(sys.argv[2]), jobs)
     if ERR_COUNT:
         stderr("\nEncountered {} errors".format(ERR_COUNT))
         raise SystemExit(1)
@@ -0,0 +1,20 @@
+// Copyright 2016 The Rust Project Developers. See the COPYRIGHT
+// file at the top-level directory of this distribution and at
+// http://rust-lang.org/COPYRIGHT.
+//
+// Licensed under the Apache License, Version 2.0 <LICENSE-APACHE or
+// http://www.apache.org/licenses/LICENSE-2.0> or the MIT license
+// <LICENSE-MIT or http://opensource.org/licenses/MIT>, at your
+// option. This file may not be copied, modified, or distributed
+// except according to those terms.
+
+// Attribute names with a prefix are kept as is by the HTML parsers, but
+// are not valid XML without a namespace declaration. Run this test twice
+// with `HTMLDOCCK_CACHE_DIR` set to check pages with them on a warm cache.
+
+/// <svg><use xlink:href="#icon"></use></svg>
+pub fn foo() {}
+
+// @has prefixed_attributes/fn.foo.html '//use/@xlink:href' '#icon'
+// @!has - '//use/@xlink:href' '#other'
+// @count - '//use' 1